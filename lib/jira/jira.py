@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 """ JIRA Rest API client """
 
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
 import io
-import json
 import os
 from pprint import pprint
+import time
+from urllib.parse import urlparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from jira.worklog import Worklog
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 JIRA_URLS = {
     'prod': 'https://jira.myfuncompany.com',
@@ -16,6 +25,20 @@ HEADERS = {'content-type': 'application/json'}
 
 TIMEOUT = 60
 
+SECONDS_PER_HOUR = 3600
+
+SEARCH_WORKERS = 8
+
+TEMPO_WORKERS = 8
+POST_RETRIES = 3
+
+FIELDS_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'aergi')
+FIELDS_TTL = 24 * 60 * 60
+
+# raise_on_status=False hands the last response back so check_http_response reports it
+RETRY = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+              raise_on_status=False)
+
 TEMPO_ACT_TO_INT_MAP = {
   'Design': 'Requirements',
   'Development': 'Design',
@@ -56,10 +79,27 @@ class JiraClient():
                 passwd = getpass()
             self.user_creds = (user, passwd)
         self.timeout = TIMEOUT
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=RETRY)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.auth = self.user_creds
+        self.session.headers.update(HEADERS)
+        self._user_cache = {}
         self.cust_flds = self.get_fields()[0] if fields else []
         if fields and debug:
             pprint(self.cust_flds)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Close pooled HTTP connections """
+        self.session.close()
+
     def get_field(self, name):
         """ Get custom field ID """
         return self.cust_flds[name]
@@ -98,12 +138,29 @@ class JiraClient():
         url = self.url + '/rest/api/2/issue'
         return self._execute('POST', url, payload=payload)
 
-    def get_fields(self):
-        """ Get custom/system fields """
-        url = self.url + '/rest/api/2/field'
-        response = requests.get(url, auth=self.user_creds, headers=HEADERS, timeout=self.timeout)
-        self.check_http_response(response)
-        fields = response.json()
+    def get_fields(self, refresh=False):
+        """ Get custom/system fields, cached on disk for AERGI_FIELDS_TTL seconds """
+        hostname = urlparse(self.url).hostname
+        cache_file = os.path.join(FIELDS_CACHE_DIR, f'fields-{hostname}.json')
+        try:
+            ttl = float(os.getenv('AERGI_FIELDS_TTL', str(FIELDS_TTL)))
+        except ValueError:
+            ttl = FIELDS_TTL
+        fields = None
+        if not refresh and os.path.isfile(cache_file) \
+                and time.time() - os.path.getmtime(cache_file) < ttl:
+            try:
+                with open(cache_file, 'rb') as inf:
+                    fields = _json.loads(inf.read())
+            except (OSError, ValueError):
+                # Unreadable or corrupt cache, fetch again
+                fields = None
+        if fields is None:
+            url = self.url + '/rest/api/2/field'
+            response = self.session.get(url, timeout=self.timeout)
+            self.check_http_response(response)
+            fields = _json.loads(response.content)
+            self._write_cache(cache_file, response.content)
 
         system_fields = {}
         custom_fields = {}
@@ -112,38 +169,91 @@ class JiraClient():
             if field['custom']:
                 custom_fields[field['name']] = field['id']
             else:
-                name = field['name'].encode('ascii', 'ignore').decode('ascii')
+                name = field['name']
+                if not name.isascii():
+                    name = name.encode('ascii', 'ignore').decode('ascii')
                 system_fields[name] = field['id']
 
         return custom_fields, system_fields
 
-    def search(self, jql, max_results=100):
-        """ JQL to return an issue or list of issues """
+    @staticmethod
+    def _write_cache(cache_file, content):
+        """ Atomically write cache file, caching is skipped if it cannot be written """
+        tmp_file = f'{cache_file}.{os.getpid()}'
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(tmp_file, 'wb') as outf:
+                outf.write(content)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+    def search(self, jql, max_results=1000, fields=None):
+        """ JQL to return an issue or list of issues, all fields unless a list is given """
+        url = self._search_url(jql, fields)
+        found_issues = self._search_page(url, 0, max_results)
+        values = found_issues['issues']
+        total = found_issues.get('total')
+        if total is None:
+            # Advance by what was returned, Jira may cap the page below max_results
+            start = len(values)
+            while found_issues['issues']:
+                found_issues = self._search_page(url, start, max_results)
+                values.extend(found_issues['issues'])
+                start += len(found_issues['issues'])
+            return values
+        if 0 < len(values) < min(max_results, total):
+            # Jira caps maxResults server side, page by what it actually returns
+            print(f'WARNING: Jira returned {len(values)} issues per page, '
+                  f'requested {max_results}')
+            max_results = len(values)
+        with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as pool:
+            futures = [pool.submit(self._search_page, url, start, max_results)
+                       for start in range(max_results, total, max_results)]
+            for future in futures:
+                values.extend(future.result()['issues'])
+        return values
+
+    def isearch(self, jql, max_results=1000, fields=None):
+        """ Iterate over JQL results, fetching the next page while the current is consumed """
+        url = self._search_url(jql, fields)
         start = 0
-        values = []
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = pool.submit(self._search_page, url, start, max_results)
+            while pending is not None:
+                found_issues = pending.result()
+                issues = found_issues['issues']
+                start += len(issues)
+                total = found_issues.get('total')
+                # An empty page ends the walk even if total promised more
+                more = bool(issues) and (start < total if total is not None else True)
+                pending = pool.submit(self._search_page, url, start, max_results) if more else None
+                yield from issues
+
+    def _search_url(self, jql, fields):
+        """ Build search URL, restricted to fields if given """
         url = f'{self.url}/rest/api/2/search?jql={jql}'
-        while True:
-            paged_url = f'{url}&startAt={start}&maxResults={max_results}'
-            response = requests.get(
-                paged_url,
-                headers=HEADERS,
-                auth=self.user_creds,
-                timeout=self.timeout)
-            self.check_http_response(response)
-            data = response.content.decode('ascii', 'ignore')
-            found_issues = json.loads(data)
-            if len(found_issues['issues']) == 0:
-                break
-            start += max_results
-            values.extend(found_issues['issues'])
-        return values
+        if fields is not None:
+            url += '&fields=' + ','.join(fields)
+        return url
+
+    def _search_page(self, url, start, max_results):
+        """ Fetch a single page of search results """
+        paged_url = f'{url}&startAt={start}&maxResults={max_results}'
+        response = self.session.get(paged_url, timeout=self.timeout)
+        self.check_http_response(response)
+        return _json.loads(response.content)
 
-    def get_issue(self, issue):
-        """ Get issue detail  """
-        url = f'{self.url}/rest/api/2/issue/{issue}?fields&expand=transitions'
-        response = requests.get(url, auth=self.user_creds, headers=HEADERS, timeout=self.timeout)
+    def get_issue(self, issue, fields=None):
+        """ Get issue detail, all fields unless a list is given """
+        fields_param = ','.join(fields) if fields is not None else ''
+        url = f'{self.url}/rest/api/2/issue/{issue}?fields={fields_param}&expand=transitions'
+        response = self.session.get(url, timeout=self.timeout)
         self.check_http_response(response)
-        return response.json()
+        return _json.loads(response.content)
 
     def update_issue(self, issue, field, value, payload=None):
         """ Update an issue field """
@@ -151,69 +261,48 @@ class JiraClient():
         url = self.url + '/rest/api/2/issue/' + issue
         if not payload:
             payload = {'fields': {field: value}}
-        data = json.dumps(payload)
-
-        response = requests.put(
-            url,
-            data,
-            headers=HEADERS,
-            auth=self.user_creds,
-            timeout=self.timeout)
-
-        self.check_http_response(response)
+        self._execute('PUT', url, payload=payload)
 
     def get_user(self, username):
         """ Get Jira user info """
         #return self.api_call('GET', f'user?username={username}')
+        if username in self._user_cache:
+            return self._user_cache[username]
         url = f'{self.url}/rest/api/2/user?username={username}'
-        response = requests.get(url, headers=HEADERS, timeout=self.timeout)
+        response = self.session.get(url, timeout=self.timeout)
         self.check_http_response(response)
-        return response.json()
+        user = _json.loads(response.content)
+        self._user_cache[username] = user
+        return user
+
+    def invalidate_user(self, username=None):
+        """ Drop cached user info, for all users if none given """
+        if username is None:
+            self._user_cache.clear()
+        else:
+            self._user_cache.pop(username, None)
 
     def assign_issue(self, issue, username):
         """ Update an issue field """
         url = self.url + '/rest/api/2/issue/' + issue + '/assignee'
         payload = {'name': username}
-        data = json.dumps(payload)
-
-        response = requests.put(
-            url,
-            data,
-            headers=HEADERS,
-            auth=self.user_creds,
-            timeout=self.timeout)
-        self.check_http_response(response)
+        self._execute('PUT', url, payload=payload)
 
     def _execute(self, type_, url, payload=None, stream=False):
         """ Carry out get/put/post/delete with data """
         if payload is not None:
-            data = json.dumps(payload)
+            data = _json.dumps(payload)
         if type_ == 'GET':
             if payload is not None:
-                response = requests.get(url, data, headers=HEADERS, auth=self.user_creds,
-                                        timeout=self.timeout, stream=stream)
+                response = self.session.get(url, data=data, timeout=self.timeout, stream=stream)
             else:
-                response = requests.get(url, headers=HEADERS, auth=self.user_creds,
-                                        timeout=self.timeout)
+                response = self.session.get(url, timeout=self.timeout)
         elif type_ == 'PUT':
-            response = requests.put(
-                url,
-                data,
-                headers=HEADERS,
-                auth=self.user_creds,
-                timeout=self.timeout
-            )
+            response = self.session.put(url, data, timeout=self.timeout)
         elif type_ == 'POST':
-            response = requests.post(
-                url,
-                data,
-                headers=HEADERS,
-                auth=self.user_creds,
-                timeout=self.timeout
-            )
+            response = self.session.post(url, data, timeout=self.timeout)
         elif type_ == 'DELETE':
-            response = requests.delete(url, headers=HEADERS, auth=self.user_creds,
-                                       timeout=self.timeout)
+            response = self.session.delete(url, timeout=self.timeout)
         else:
             raise RuntimeError('Invalid request type: ' + type_)
 
@@ -232,7 +321,7 @@ class JiraClient():
         if stream:
             results = response.content
         elif response.status_code >= 200 and response.status_code <= 203:
-            results = response.json()
+            results = _json.loads(response.content)
         else:
             results = None
         return results
@@ -243,12 +332,12 @@ class JiraClient():
         try:
             response.raise_for_status()
         except requests.exceptions.HTTPError as err:
-            status_code = response.status_code
-            error = json.dumps(response.text)
-            if status_code != 200:
-                print(response.text)
-                error = json.loads(response.text)
-                raise RuntimeError(f'HTTP error {status_code}: {error}') from err
+            print(response.text)
+            try:
+                error = _json.loads(response.content)
+            except ValueError:
+                error = response.text
+            raise RuntimeError(f'HTTP error {response.status_code}: {error}') from err
 
     def api_call(self, type_, params=None, api='api', version='3', endpoint=False, url=None,
                 payload=None, stream=False):
@@ -269,25 +358,20 @@ class JiraClient():
     def attach_file(self, issue, file_name=None, content=None, name='file'):
         """ Attach file to issue """
         url = f'{self.url}/rest/api/2/issue/{issue}/attachments'
-        headers = {"X-Atlassian-Token": "nocheck"}
+        # Drop the session JSON content-type so requests sets the multipart one
+        headers = {"X-Atlassian-Token": "nocheck", 'content-type': None}
 
         if file_name:
-            file_ = None
-            with open(file_name, 'rb') as read:
-                file_ = read.read()
-            files = {'file': (name, file_)}
+            # Hand the open file to requests instead of reading it into a bytes copy first
+            with open(file_name, 'rb') as file_:
+                files = {'file': (name, file_)}
+                response = self.session.post(url, files=files, headers=headers,
+                                             timeout=self.timeout)
         elif content:
             if not name:
                 raise RuntimeError('You must provide a name for string to be attached')
             files = {'file': (name, io.BytesIO(str.encode(content)))}
-
-        response = requests.post(
-            url,
-            auth=self.user_creds,
-            files=files,
-            headers=headers,
-            timeout=self.timeout
-        )
+            response = self.session.post(url, files=files, headers=headers, timeout=self.timeout)
 
         self.check_http_response(response)
 
@@ -311,7 +395,53 @@ class JiraClient():
 
     def tempo_log(self, worker, date, log, test=False):
         """ Log time """
-        activity = log['activity']
+        payload = self._build_log_payload(worker, date, log)
+        if not test:
+            self._execute('POST', f'{self.url}/rest/tempo-timesheets/4/worklogs', payload=payload)
+
+    def tempo_log_bulk(self, worker, entries, test=False):
+        """ Log time for a list of (date, log) entries concurrently """
+        entries = list(entries)
+        payloads = [self._build_log_payload(worker, date, log) for date, log in entries]
+        if test or not payloads:
+            return
+        url = f'{self.url}/rest/tempo-timesheets/4/worklogs'
+        with ThreadPoolExecutor(max_workers=TEMPO_WORKERS) as pool:
+            futures = [pool.submit(self._post_worklog, url, payload) for payload in payloads]
+        failures = []
+        for (date, log), future in zip(entries, futures):
+            try:
+                future.result()
+            except (RuntimeError, requests.exceptions.RequestException) as err:
+                failures.append(f'{date} {log.hours} {log.issue} {log.comment}: {err}')
+        if failures:
+            raise RuntimeError(f'{len(failures)} of {len(payloads)} worklogs failed, '
+                               'the others were logged:\n' + '\n'.join(failures))
+
+    def _post_worklog(self, url, payload):
+        """ POST worklog, retrying while Tempo answers 429 Too Many Requests """
+        # POST is not retried by the session adapter, a 429 is safe to repeat as it was rejected
+        data = _json.dumps(payload)
+        for attempt in range(POST_RETRIES + 1):
+            response = self.session.post(url, data, timeout=self.timeout)
+            if response.status_code != 429 or attempt == POST_RETRIES:
+                break
+            try:
+                delay = float(response.headers['Retry-After'])
+            except (KeyError, ValueError):
+                delay = RETRY.backoff_factor * 2 ** attempt
+            time.sleep(delay)
+        if self.debug:
+            print('PAYLOAD')
+            print(payload)
+            print('Response.text')
+            print(response.text)
+        self.check_http_response(response)
+
+    @staticmethod
+    def _build_log_payload(worker, date, log):
+        """ Build Tempo worklog payload """
+        activity = log.activity
         if activity not in TEMPO_ACT_TO_INT_MAP:
             raise RuntimeError(f'Unable to find activity in internal activity mapping: {activity}')
         act_code = TEMPO_ACT_TO_INT_MAP[activity]
@@ -319,16 +449,15 @@ class JiraClient():
             "attributes": {
                 "_ActivityType_": act_code,
             },
-            "billableSeconds": int(float(log['hours']) * 3600),
+            "billableSeconds": int(float(log.hours) * SECONDS_PER_HOUR),
             "endDate": date,
-            "originTaskId": log['issue'],
+            "originTaskId": log.issue,
             "started": date,
-            "timeSpentSeconds": int(float(log['hours']) * 3600),
+            "timeSpentSeconds": int(float(log.hours) * SECONDS_PER_HOUR),
             "worker": worker,
-            "comment": log['comment'],
+            "comment": log.comment,
         }
-        if not test:
-            self._execute('POST', f'{self.url}/rest/tempo-timesheets/4/worklogs', payload=payload)
+        return payload
 
     def tempo_get(self, worker, date1, date2):
         """ Get time """
@@ -339,21 +468,20 @@ class JiraClient():
         }
         resp = self.tempo_api_call('worklogs/search', payload=payload)
         period = {}
+        # Activities without an internal code are returned by Tempo under their own name
+        int_to_act = TEMPO_INT_TO_ACT_MAP.get
         for item in resp:
             activity = item['attributes']['_ActivityType_']['value']
-            hours = item['timeSpentSeconds']
-            comment = item['comment']
             started = item['started'][:10]
-            period.setdefault(started, [])
             issue = item['issue']
-            period[started].append({
-                'id': item['tempoWorklogId'],
-                'issue': issue['key'],
-                'activity': TEMPO_INT_TO_ACT_MAP[activity],
-                'comment': comment,
-                'hours': hours/60/60,
-                'issue_summary': issue['summary']
-            })
+            period.setdefault(started, []).append(Worklog(
+                id=item['tempoWorklogId'],
+                issue=issue['key'],
+                activity=int_to_act(activity, activity),
+                comment=item['comment'],
+                hours=item['timeSpentSeconds'] / SECONDS_PER_HOUR,
+                issue_summary=issue['summary'],
+            ))
         return period
 
     def tempo_delete(self, id_, test=False):
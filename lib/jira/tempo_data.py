@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 """ Tempo timesheet manipulation """
 
-import json
 import os
 import re
 from pprint import pprint # pylint: disable=unused-import
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+from jira.worklog import Worklog
 
 
 COMMENT_TO_ACT_MAP = 'comment-to-act.json'
@@ -14,31 +22,85 @@ WORK_MAP_CUSTOM = 'work-custom.json'
 ACTIVITY_MAP = 'activity.json'
 ISSUE_SUMMARY_MAP = 'issues.json'
 
+ISSUE_KEY_RE = re.compile(r'[A-Z0-9]+-[0-9]+$')
+DATE_LINE_RE = re.compile(r'(\d{4}-\d{2}-\d{2}):[ ]*$')
+LOG_LINE_RE = re.compile(r'([ ]*)-(?:[ ]+(.*?))?[ ]*$')
+YAML_INDICATORS = '\'"[]{},&*!|>%@`?-'
+YAML_RESOLVER = yaml.resolver.Resolver()
+YAML_STR_TAG = 'tag:yaml.org,2002:str'
+
+_CONFIG_CACHE = {}
+
+
+def load_config(path):
+    """ Load json config file, cached until its mtime changes. Do not mutate the result """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _CONFIG_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as inf:
+        data = _json.loads(inf.read())
+    _CONFIG_CACHE[path] = (mtime, data)
+    return data
+
+
+def _parse_tempo_file(file_name):
+    """ Parse plain 'date: list of log lines' files without YAML, None if anything else """
+    file_data = {}
+    logs = None
+    indent = None
+    with open(file_name, encoding='utf-8') as inf:
+        for line in inf:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('#'):
+                continue
+            matched = DATE_LINE_RE.match(line)
+            if matched:
+                logs = file_data[matched.group(1)] = []
+                indent = None
+                continue
+            matched = LOG_LINE_RE.match(line)
+            if not matched or logs is None:
+                return None
+            if indent is None:
+                indent = matched.group(1)
+            elif matched.group(1) != indent:
+                # Uneven items are a parse error or a continued scalar in YAML
+                return None
+            value = matched.group(2)
+            if not value or value.startswith('#'):
+                logs.append(None)
+            elif value[0] in YAML_INDICATORS or ': ' in value or ' #' in value \
+                    or value.endswith(':') or '\t' in value \
+                    or YAML_RESOLVER.resolve(yaml.ScalarNode, value, (True, False)) != YAML_STR_TAG:
+                # null, ~, booleans and numbers are not strings in YAML
+                return None
+            else:
+                logs.append(value)
+    return file_data
+
 
 class TempoData:
     """ Tempo time entries """
     def __init__(self):
         self.home = os.environ['TEMPI_HOME']
         self.c2a = self.get_config(COMMENT_TO_ACT_MAP)
-        self.cfg = self.get_config(WORK_MAP)
-        self.cfg.update(self.get_config_custom(WORK_MAP_CUSTOM))
+        self.c2a_map = [(re.compile(key), val) for key, val in self.c2a['map']]
+        self.cfg = {**self.get_config(WORK_MAP), **self.get_config_custom(WORK_MAP_CUSTOM)}
         self.activity_map = self.get_config(ACTIVITY_MAP)
         self.issues = self.get_config(ISSUE_SUMMARY_MAP)
         self.entries = {}
+        self._index = None
 
     def get_config(self, file):
         """ Get config file """
-        path = f'{self.home}/config/{file}'
-        with open(path, encoding='utf-8') as inf:
-            data = json.load(inf)
-        return data
+        return load_config(f'{self.home}/config/{file}')
 
     @staticmethod
     def get_config_custom(file):
         """ Get custom config file, optional """
         if os.path.isfile(file):
-            with open(file, encoding='utf-8') as inf:
-                data = json.load(inf)
+            data = load_config(file)
         else:
             data = {}
         return data
@@ -46,8 +108,8 @@ class TempoData:
     def diff(self, other):
         """ Compare with another instance of tempo data """
         results = {}
-        dates = set(list(self.entries.keys()) + list(other.entries.keys()))
-        for date in dates:
+        dates = self.entries.keys() | other.entries.keys()
+        for date in sorted(dates):
             results.setdefault(date, {'+': [], '-': []})
             if date in self.entries:
                 for log in self.entries[date]:
@@ -61,37 +123,36 @@ class TempoData:
 
     def log_exists(self, date, log):
         """ Check whether log exists for date """
-        exists = False
-        if date in self.entries:
-            for entry_log in self.entries[date]:
-                if self.log_matches(entry_log, log):
-                    exists = True
-                    break
-        return exists
-
-    def log_matches(self, log1, log2):
-        """ Check whether 2 logs match """
-        matches = True
-        for key in ['hours', 'issue', 'activity', 'comment']:
-            if log1[key] != log2[key]:
-                matches = False
-                break
-        return matches
+        if self._index is None:
+            self._index = {
+                day: {self.log_key(entry_log) for entry_log in logs}
+                for day, logs in self.entries.items()
+            }
+        return self.log_key(log) in self._index.get(date, ())
+
+    @staticmethod
+    def log_key(log):
+        """ Hashable key of the fields compared between logs """
+        return (log.hours, log.issue, log.activity, log.comment)
 
     def from_file(self, file_name):
         """ Parse input file """
-        with open(file_name, encoding='utf-8') as inf:
-            file_data = yaml.safe_load(inf)
-            for date, logs in (sorted(file_data.items())):
-                self.parse_file_date_entries(str(date), logs)
+        file_data = _parse_tempo_file(file_name)
+        if file_data is None:
+            with open(file_name, encoding='utf-8') as inf:
+                file_data = yaml.load(inf, Loader=SafeLoader)
+        for date, logs in (sorted(file_data.items())):
+            self.parse_file_date_entries(str(date), logs)
 
     def from_jira(self, jira, worker, date_from, date_to):
         """ Get data from jira """
         self.entries = jira.tempo_get(worker, date_from, date_to)
+        self._index = None
 
     def parse_file_date_entries(self, date, logs):
         """ Parse time logs for a particular date """
         self.entries.setdefault(date, [])
+        self._index = None
         if logs is not None:
             for line in logs:
                 if line:
@@ -107,8 +168,9 @@ class TempoData:
         if len(spl) == 3:
             comment = spl[2]
 
-        if work_item not in self.cfg:
-            if re.match('[A-Z0-9]+-[0-9]+$', work_item):
+        cfg_entry = self.cfg.get(work_item)
+        if cfg_entry is None:
+            if ISSUE_KEY_RE.match(work_item):
                 issue = work_item
                 if comment is None:
                     raise RuntimeError('Ticket number specified as work item, '
@@ -119,25 +181,25 @@ class TempoData:
                                    f'{work_item}. See {self.home}/config/{WORK_MAP} '
                                    f'and ./{WORK_MAP_CUSTOM}')
         else:
-            issue = self.cfg[work_item]['issue']
-            if 'activity' in self.cfg[work_item]:
-                activity = self.cfg[work_item]['activity']
-            else:
+            issue = cfg_entry['issue']
+            activity = cfg_entry.get('activity')
+            if activity is None:
                 activity = self.comment_to_activity(comment)
 
         use_comment = work_item
         if comment is not None:
             use_comment += f' - {comment}'
-        entry = {
-            'hours': float(hours),
-            'issue': issue,
-            'activity': self.activity_map[activity],
-            'comment': use_comment,
-            'debug_work_item': work_item,
-        }
-        if entry['issue'] in self.issues:
-            entry['issue_summary'] = self.issues[entry['issue']]
+        entry = Worklog(
+            id=None,
+            issue=issue,
+            activity=self.activity_map[activity],
+            comment=use_comment,
+            hours=float(hours),
+            issue_summary=self.issues.get(issue),
+            work_item=work_item,
+        )
         self.entries[date].append(entry)
+        self._index = None
 
     def comment_to_activity(self, comment):
         """ Convert comment to activity """
@@ -147,8 +209,8 @@ class TempoData:
                 activity = val
                 break
         if activity is None:
-            for key, val in self.c2a['map']:
-                if re.search(key, comment):
+            for regex, val in self.c2a_map:
+                if regex.search(comment):
                     activity = val
                     break
         return activity
@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+""" Tempo worklog record """
+
+from collections import namedtuple
+
+
+Worklog = namedtuple('Worklog', 'id issue activity comment hours issue_summary work_item',
+                     defaults=(None,))
@@ -4,16 +4,25 @@
 # pylint: disable=consider-using-f-string, logging-format-interpolation
 
 
+import atexit
+from collections import OrderedDict
 import hashlib
 import json
 import logging
+import logging.handlers
 import os
-import pickle
+import queue
 import re
+import shlex
+import shutil
 import socket
 import subprocess
 import sys
 import time
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 
 # pylint: disable=too-few-public-methods, import-outside-toplevel
@@ -32,9 +41,30 @@ class DispatchingFormatter:
 
 SDE_CONFIG = {
     'logger': None,
+    'listener': None,
     'debug': True
 }
 FORMATTER_NO_TSTAMP = logging.Formatter('%(message)s')
+# Stable for the life of the process, read once instead of through os.environ per call
+STABLE_ENV = {name: os.environ.get(name) for name in ('HOME', 'SHELL', 'LOGNAME', 'PATH')}
+# source_file results keyed by file, its mtime and the input environment
+SOURCE_CACHE = OrderedDict()
+SOURCE_CACHE_SIZE = 32
+LOG_FILE_BUFFER = 64 * 1024
+LOG_FILE_CAPACITY = 64
+HASH_CHUNK = 1024 * 1024
+EXEC_READ_CHUNK = 64 * 1024
+EXPORT_RE = re.compile(r'^\s*export\s+(\w+)=(?:"([^"]*)"|\'([^\']*)\'|(\S+))\s*$')
+JSON_ERRORS = (json.decoder.JSONDecodeError,) + ((ijson.JSONError,) if ijson else ())
+# Includes N and I, json.loads accepts NaN and Infinity
+JSON_START_CHARS = '{["tfnNI-0123456789'
+TSTAMP_FORMATS = {
+    (True, True): '%Y%m%d_%H%M%S',
+    (True, False): '%Y%m%d',
+    (False, True): '%Y/%m/%d %H:%M:%S',
+    (False, False): '%Y/%m/%d',
+}
+SHELL_META_RE = re.compile(r'[|&;<>()$`\\"\'*?\[\]{}~!#\n]')
 
 
 def sde_debug(debug=None):
@@ -47,16 +77,27 @@ def sde_debug(debug=None):
 
 def get_req_var(var):
     """ Get required env var """
-    if var not in os.environ:
+    try:
+        return os.environ[var]
+    except KeyError:
+        raise RuntimeError(f'Variable not set: {var}') from None
+
+
+def get_stable_var(var):
+    """ Get required env var from the values read at import """
+    value = STABLE_ENV[var]
+    if value is None:
         raise RuntimeError(f'Variable not set: {var}')
-    return os.environ[var]
+    return value
 
 
 def sde_get_log_dir(subdir=None):
     """ Get log directory """
-    log_dir = os.getenv('SDE_LOG_DIR') or os.environ['HOME'] + '.sde-local/logs'
-    if not subdir is None:
-        log_dir += '/' + subdir
+    log_dir = os.getenv('SDE_LOG_DIR')
+    if not log_dir:
+        log_dir = os.path.join(get_stable_var('HOME'), '.sde-local', 'logs')
+    if subdir is not None:
+        log_dir = os.path.join(log_dir, subdir)
     return log_dir
 
 
@@ -76,7 +117,12 @@ def init_logging(name=None, dir='sde', stdout_only=False, command=None,
     SDE_CONFIG['logger'].setLevel(logging.DEBUG)
 
     formatter = set_logging_formatter(use_tstamp)
+    existing = list(SDE_CONFIG['logger'].handlers)
     log_file = setup_log_file(name, command, dir, formatter, stdout_only)
+    file_handlers = [hdl for hdl in SDE_CONFIG['logger'].handlers if hdl not in existing]
+    if file_handlers:
+        start_log_listener(file_handlers)
+    # Console stays synchronous so log lines keep their order relative to print()
     set_logging_handler(stdout_only, formatter)
 
     if log_file is not None and not quiet:
@@ -92,6 +138,19 @@ def init_logging(name=None, dir='sde', stdout_only=False, command=None,
     return log_file
 
 
+def start_log_listener(handlers):
+    """ Move handlers behind a queue so that logging callers never wait on file I/O """
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        SDE_CONFIG['logger'].removeHandler(handler)
+    SDE_CONFIG['logger'].addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    SDE_CONFIG['listener'] = listener
+    # Registered after the log file callbacks, so records are drained before the file closes
+    atexit.register(listener.stop)
+
+
 def set_logging_formatter(use_tstamp):
     """ Set logging formatter with or without time stamp """
     if use_tstamp:
@@ -107,9 +166,8 @@ def setup_log_file(name, command, dir_, formatter, stdout_only):
     """ Set up log file """
     if not stdout_only:
         log_dir_var = 'SDE_LOG_DIR'
-        log_dir = '{}/{}'.format(os.environ[log_dir_var], dir_)
-        if not os.path.isdir(log_dir):
-            os.makedirs(log_dir)
+        log_dir = f'{os.environ[log_dir_var]}/{dir_}'
+        os.makedirs(log_dir, exist_ok=True)
 
         if command is None:
             log_file = '%s/%s_%s.log' % (
@@ -117,13 +175,20 @@ def setup_log_file(name, command, dir_, formatter, stdout_only):
         else:
             log_file = '%s/%s_%s_%s.log' % (
                 log_dir, tstamp(), name, command)
-        lfh = logging.FileHandler(log_file)
+        # pylint: disable=consider-using-with
+        raw = open(log_file, 'a', buffering=LOG_FILE_BUFFER, encoding='utf-8')
+        lfh = logging.StreamHandler(raw)
         lfh.setLevel(logging.DEBUG)
         lfh.setFormatter(DispatchingFormatter(
             {'no_tstamp': FORMATTER_NO_TSTAMP,},
             formatter,
         ))
-        SDE_CONFIG['logger'].addHandler(lfh)
+        buffered = logging.handlers.MemoryHandler(
+            capacity=LOG_FILE_CAPACITY, flushLevel=logging.WARNING, target=lfh, flushOnClose=True)
+        SDE_CONFIG['logger'].addHandler(buffered)
+        # atexit runs last registered first: flush records, then close the file
+        atexit.register(raw.close)
+        atexit.register(buffered.flush)
     else:
         log_file = None
     return log_file
@@ -145,98 +210,146 @@ def set_logging_handler(stdout_only, formatter):
     SDE_CONFIG['logger'].addHandler(lch)
 
 
-def source_file(file_=os.environ['SDE_CONFIG'], blank_env=False, add_env=None):
-    """ Source profile """
+def source_file(file_=None, blank_env=False, add_env=None):
+    """ Source profile, $SDE_CONFIG by default """
+    if file_ is None:
+        file_ = get_req_var('SDE_CONFIG')
     if blank_env:
         env = {
-            'PATH': os.environ['PATH'],
-            'LOGNAME': os.environ['LOGNAME'],
-            'HOME': os.environ['HOME'],
+            name: STABLE_ENV[name]
+            for name in ('PATH', 'LOGNAME', 'HOME')
+            if STABLE_ENV[name] is not None
         }
     else:
-        env = os.environ
+        env = dict(os.environ)
 
     if add_env is not None:
         env.update(add_env)
 
-    source = 'source {}'.format(file_)
-    dump = f'{sys.executable} -c "import sys,os,pickle; ' \
-            'sys.stdout.buffer.write(pickle.dumps(dict(os.environ)))"'
-    output = subprocess.check_output(
-        '%s && %s' %
-        (source, dump), shell=True, stdin=subprocess.PIPE, env=env, executable=os.environ['SHELL'])
     try:
-        env_result = pickle.loads(output)
-    except pickle.UnpicklingError:
-        eprint('Error while pickle.loads:\n{}'.format(output))
-        raise
+        key = (os.path.realpath(file_), os.stat(file_).st_mtime_ns, blank_env,
+               tuple(sorted(env.items())))
+    except OSError:
+        key = None
+    if key in SOURCE_CACHE:
+        SOURCE_CACHE.move_to_end(key)
+        return dict(SOURCE_CACHE[key])
+
+    exports = _parse_simple_profile(file_)
+    if exports is not None:
+        env_result = dict(env)
+        env_result.update(exports)
+    else:
+        env_result = _source_with_shell(file_, env)
     if blank_env:
         for var in ['_', 'SHLVL', 'HOME', 'LOGNAME', 'PWD', 'PATH']:
             if var in env_result:
                 del env_result[var]
+    if key is not None:
+        SOURCE_CACHE[key] = dict(env_result)
+        if len(SOURCE_CACHE) > SOURCE_CACHE_SIZE:
+            SOURCE_CACHE.popitem(last=False)
     return env_result
 
 
-def dprint(msg, data=None):
+def _source_with_shell(file_, env):
+    """ Source profile in a shell and return the resulting environment """
+    # Profile output goes to stderr so only env -0 writes to the captured stdout
+    source = 'source {} >&2'.format(file_)
+    output = subprocess.check_output(
+        '%s && env -0' %
+        source, shell=True, stdin=subprocess.PIPE, env=env, executable=get_stable_var('SHELL'),
+        close_fds=False)
+    env_result = {}
+    for item in output.split(b'\0')[:-1]:
+        name, sep, value = item.partition(b'=')
+        if not sep or not name:
+            raise RuntimeError('Unexpected output sourcing {}: {!r}'.format(file_, item))
+        env_result[os.fsdecode(name)] = os.fsdecode(value)
+    return env_result
+
+
+def _parse_simple_profile(file_):
+    """ Parse profile made of plain export lines only, None if it needs a shell """
+    exports = {}
+    try:
+        with open(file_, encoding='utf-8') as inf:
+            lines = inf.readlines()
+    except (OSError, UnicodeDecodeError):
+        return None
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        matched = EXPORT_RE.match(line)
+        if not matched:
+            return None
+        dquoted, squoted, bare = matched.group(2, 3, 4)
+        if dquoted is not None:
+            if any(char in dquoted for char in '$`\\'):
+                return None
+            value = dquoted
+        elif squoted is not None:
+            value = squoted
+        else:
+            if SHELL_META_RE.search(bare):
+                return None
+            value = bare
+        exports[matched.group(1)] = value
+    return exports
+
+
+def _ascii(text):
+    """ Drop non-ascii characters, skipping the round trip for ascii text """
+    text = str(text)
+    if text.isascii():
+        return text
+    return text.encode('ascii', 'ignore').decode('ascii')
+
+
+def _emit(level, msg, data, sort):
+    """ Log message and optional data items at given level """
+    logger = SDE_CONFIG['logger']
+    if not logger.isEnabledFor(level):
+        return
+    parts = [str(msg)]
+    if data is not None:
+        items = sorted(data.items()) if sort else data.items()
+        parts.extend(f'  - {key}: {value}' for key, value in items)
+    logger.log(level, _ascii('\n'.join(parts)))
+
+
+def dprint(msg, data=None, sort=False):
     """ Debug print, including tstamp """
     if SDE_CONFIG['debug'] and msg is not None and msg != '' and SDE_CONFIG['logger'] is not None:
-        SDE_CONFIG['logger'].debug((str(msg)).encode('ascii', 'ignore').decode('ascii'))
-        if data is not None:
-            for key, value in sorted(data.items()):
-                line = f'  - {key}: {value}'
-                SDE_CONFIG['logger'].debug(line.encode('ascii', 'ignore').decode('ascii'))
+        _emit(logging.DEBUG, msg, data, sort)
 
 
-def iprint(msg, data=None):
+def iprint(msg, data=None, sort=False):
     """ Informational print, including tstamp """
     if msg is not None and msg != '':
-        SDE_CONFIG['logger'].info((str(msg)).encode('ascii', 'ignore').decode('ascii'))
-        if data is not None:
-            for key, value in sorted(data.items()):
-                line = f'  - {key}: {value}'
-                SDE_CONFIG['logger'].info(line.encode('ascii', 'ignore').decode('ascii'))
+        _emit(logging.INFO, msg, data, sort)
 
 
-def wprint(msg, data=None):
+def wprint(msg, data=None, sort=False):
     """ Warning print, including tstamp """
     if msg is not None and msg != '':
-        SDE_CONFIG['logger'].warning((str(msg)).encode('ascii', 'ignore').decode('ascii'))
-        if data is not None:
-            for key, value in sorted(data.items()):
-                line = f'  - {key}: {value}'
-                SDE_CONFIG['logger'].warning(line.encode('ascii', 'ignore').decode('ascii'))
+        _emit(logging.WARNING, msg, data, sort)
 
 
-def eprint(msg, data=None):
+def eprint(msg, data=None, sort=False):
     """ Error print, including tstamp """
     if msg is not None and msg != '':
-        SDE_CONFIG['logger'].error((str(msg)).encode('ascii', 'ignore').decode('ascii'))
-        if data is not None:
-            for key, value in sorted(data.items()):
-                line = f'  - {key}: {value}'
-                SDE_CONFIG['logger'].error(line.encode('ascii', 'ignore').decode('ascii'))
+        _emit(logging.ERROR, msg, data, sort)
 
 
 def tstamp(val=None, form=1, show_time=True, milli=False):
     """ Return either current, or specified tstamp string """
-    if val is None:
-        ttt = time.localtime()
-    else:
-        ttt = time.localtime(val)
-    if form == 1:
-        if show_time:
-            result = time.strftime('%Y%m%d_%H%M%S', ttt)
-        else:
-            result = time.strftime('%Y%m%d', ttt)
-    else:
-        if show_time:
-            result = time.strftime('%Y/%m/%d %H:%M:%S', ttt)
-        else:
-            result = time.strftime('%Y/%m/%d', ttt)
+    ttt = time.localtime() if val is None else time.localtime(val)
+    result = time.strftime(TSTAMP_FORMATS[(form == 1, bool(show_time))], ttt)
     if milli:
-        cur = time.time()
-        ms_ = ((cur - int(cur)) * 1000)
-        result = '{}.{}'.format(result, ms_)
+        ms_ = int((time.time() % 1) * 1000)
+        result = '{}.{:03d}'.format(result, ms_)
     return result
 
 
@@ -276,17 +389,17 @@ def _sde_exec_cmd(cmd, msg=None, echo=False, show=False,
     if log and SDE_CONFIG['logger']:
         dprint('Executing: ' + cmd + ', in directory: ' + os.getcwd())
 
-    # pylint: disable=consider-using-with
-    proc = subprocess.Popen(
+    proc = _spawn_fast(
         cmd,
-        shell=True,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         env=os.environ)
 
+    logger = SDE_CONFIG['logger']
+    debug_enabled = bool(logger and SDE_CONFIG['debug'] and logger.isEnabledFor(logging.DEBUG))
     output = []
-    for line in proc.stdout:
-        str_ = line.decode('utf-8', 'ignore').rstrip()
+    for line in _read_lines(proc.stdout):
+        str_ = line.rstrip()
         if show:
             if str_ is not None and str_ != '':
                 if show_tstamp:
@@ -296,7 +409,8 @@ def _sde_exec_cmd(cmd, msg=None, echo=False, show=False,
         else:
             if str_ is not None and str_ != '' and SDE_CONFIG['logger']:
                 if show_tstamp:
-                    dprint(str_)
+                    if debug_enabled:
+                        dprint(str_)
                 else:
                     logging.getLogger('no_tstamp').info(str_)
         output.append(str_)
@@ -324,54 +438,100 @@ def _sde_exec_cmd(cmd, msg=None, echo=False, show=False,
     return retval, ret
 
 
+def new_hash(algorithm, data=b''):
+    """ Create OpenSSL backed hash object, digests are checksums and not for security """
+    return hashlib.new(algorithm, data, usedforsecurity=False)
+
+
+def file_digest(file, algorithm):
+    """ Return file digest, hashing in chunks rather than reading the whole file """
+    with open(file, 'rb') as ifp:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(ifp, lambda: new_hash(algorithm)).hexdigest()
+        hsh = new_hash(algorithm)
+        buf = bytearray(HASH_CHUNK)
+        view = memoryview(buf)
+        while size := ifp.readinto(buf):
+            hsh.update(view[:size])
+    return hsh.hexdigest()
+
+
+def _read_lines(stream):
+    """ Yield decoded lines from a pipe, reading and decoding it in large chunks """
+    fd_ = stream.fileno()
+    buf = bytearray()
+    while chunk := os.read(fd_, EXEC_READ_CHUNK):
+        buf += chunk
+        cut = buf.rfind(b'\n') + 1
+        if cut:
+            # Decode only complete lines so multi-byte characters are never split
+            yield from buf[:cut].decode('utf-8', 'ignore').split('\n')[:-1]
+            del buf[:cut]
+    if buf:
+        yield buf.decode('utf-8', 'ignore')
+
+
+def _spawn_fast(cmd, **kwargs):
+    """ Popen command, exec'ing it directly when it needs no shell so posix_spawn is used """
+    # Python fds are non-inheritable, so close_fds=False is safe and keeps the spawn fast path
+    # pylint: disable=consider-using-with
+    args = None if SHELL_META_RE.search(cmd) else shlex.split(cmd)
+    if args and '=' not in args[0]:
+        executable = shutil.which(args[0])
+        if executable is not None:
+            try:
+                return subprocess.Popen(args, executable=executable, close_fds=False, **kwargs)
+            except OSError:
+                # e.g. ENOEXEC for scripts without a shebang line, which /bin/sh still runs
+                pass
+    return subprocess.Popen(cmd, shell=True, close_fds=False, **kwargs)
+
+
 def md5_digest(file=None, data=None):
     """ Return either file or data md5 digest """
     if data is None:
-        with open(file, 'rb') as ifp:
-            data = ifp.read()
-    digest = hashlib.md5(data).hexdigest()
+        return file_digest(file, 'md5')
+    digest = new_hash('md5', data).hexdigest()
     return digest
 
 
 def sha256_digest(file):
     """ Return either file or data sha256 digest """
-    with open(file, 'rb') as ifp:
-        data = ifp.read()
-        digest = hashlib.sha256(data).hexdigest()
-    return digest
+    return file_digest(file, 'sha256')
 
 
-def check_server_port(host, port):
+def check_server_port(host, port, timeout=2.0):
     """ Check whether server port is connect-able """
-    sock = socket.socket()
-    result = True
-    try:
-        sock.connect((host, int(port)))
-    except: # pylint: disable=bare-except
-        result = False
-    sock.close()
-    return result
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect((host, int(port)))
+        except OSError:
+            return False
+    return True
 
 
 def set_export(file_, dict_):
     """ Add export var to a sub-profile """
     if '/' not in file_:
-        file_ = os.environ['HOME'] + '/' + file_
+        file_ = get_stable_var('HOME') + '/' + file_
     with open(file_, 'r', encoding='utf-8') as ifp:
         cont = ifp.readlines()
 
     found = []
     new_content = []
+    export_re = re.compile(r'(\s*export ({})=).*'.format('|'.join(map(re.escape, dict_))))
     for line in cont:
         new_line = line
-        for name, value in dict_.items():
-            matched = re.search(r'(\s*export {}=).*'.format(name), line)
-            if matched:
-                if value is None:
-                    new_line = None
-                else:
-                    new_line = '{}"{}"\n'.format(matched.group(1), value)
-                    found.append(name)
+        matched = export_re.search(line) if dict_ else None
+        if matched:
+            name = matched.group(2)
+            value = dict_[name]
+            if value is None:
+                new_line = None
+            else:
+                new_line = '{}"{}"\n'.format(matched.group(1), value)
+                found.append(name)
         if new_line is not None:
             new_content.append(new_line)
 
@@ -396,10 +556,16 @@ def handle_error(print_error=True, exit_code=None):
 
 def is_json(text):
     """ Test if string is json """
+    if not isinstance(text, (str, bytes, bytearray)):
+        return False
+    if isinstance(text, str):
+        stripped = text.lstrip()
+        if not stripped or stripped[0] not in JSON_START_CHARS:
+            return False
     result = True
     try:
         _ = json.loads(text)
-    except json.decoder.JSONDecodeError:
+    except ValueError:
         result = False
     return result
 
@@ -408,13 +574,18 @@ def validate_json(file_name, quiet=False):
     """ Validate json file """
     valid = True
     try:
-        with open(file_name, encoding='utf-8') as inf:
-            _ = json.load(inf)
+        with open(file_name, 'rb') as inf:
+            if ijson is not None:
+                # Drain parser events, without building the document
+                for _ in ijson.parse(inf):
+                    pass
+            else:
+                _ = json.loads(inf.read())
     except FileNotFoundError:
         valid = False
         if not quiet:
             print('File not found: {}'.format(file_name), file=sys.stderr)
-    except json.decoder.JSONDecodeError:
+    except JSON_ERRORS:
         valid = False
         if not quiet:
             print('Json file is not valid: {}'.format(file_name), file=sys.stderr)